@@ -1,144 +1,781 @@
 import os
 import io
+import re
+import shutil
+import sys
+import hashlib
+import sqlite3
 import tempfile
+import threading
+import queue
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, wraps
+from types import SimpleNamespace
+import click
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+import orjson
 from flask_cors import CORS
 from supabase import create_client, Client
 from dotenv import load_dotenv
+import jwt
+from cachetools import TTLCache
+from redis import Redis
+from rq import Queue
+
+# --- CPU Thread Limits ---
+# torch, numpy, onnxruntime and ctranslate2 each default to one thread per
+# core, so N gunicorn workers would oversubscribe the CPU N times over.
+# Split the cores between workers instead. This has to run before those
+# libraries are imported.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1")) # gunicorn workers
+CPU_THREADS = max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+for thread_var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"):
+    os.environ.setdefault(thread_var, str(CPU_THREADS))
 
 # --- AI Imports ---
-import whisper
+import ctranslate2
+from faster_whisper import WhisperModel, decode_audio
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+import torch
 from PIL import Image
 from ultralytics import YOLO
 
+torch.set_num_threads(CPU_THREADS)
+
 # Load your secret keys from the .env file
 load_dotenv()
 
 # --- Flask App Setup ---
+class ORJSONProvider(JSONProvider):
+    """Serves request.get_json() and jsonify() with orjson instead of the stdlib json."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response, skipping the
+        # bytes -> str -> bytes round trip dumps() would add.
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=DefaultJSONProvider.default)
+        return self._app.response_class(body, mimetype="application/json")
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app) # Allows your team's apps to call your API
 
 # --- Supabase Connection ---
 url = os.environ.get("SUPABASE_URL")
 key = os.environ.get("SUPABASE_KEY") # Your SERVICE_ROLE key
 
-if not url or not key:
-    print("FATAL ERROR: SUPABASE_URL and SUPABASE_KEY not found")
+class SupabaseConfigError(RuntimeError):
+    """SUPABASE_URL / SUPABASE_KEY are missing. Must surface as a 500, never as a 401."""
+
+# Created on first use, so importing this module (e.g. for the flask CLI)
+# doesn't open a connection to Supabase.
+@lru_cache(maxsize=1)
+def get_supabase() -> Client:
+    # Refuse outright instead of handing None to create_client and failing
+    # (or timing out) in some confusing way on every request.
+    if not url or not key:
+        raise SupabaseConfigError("FATAL ERROR: SUPABASE_URL and SUPABASE_KEY not found")
+
+    # We initialize Supabase with the SERVICE_ROLE key for admin powers
+    return create_client(url, key)
+
+def is_flask_cli():
+    """True when this module was imported by the flask command (flask or python -m flask)."""
+    return (os.path.basename(sys.argv[0]) in ("flask", "flask.exe")
+            or sys.argv[0].endswith(os.path.join("flask", "__main__.py")))
+
+# Refuse to start without credentials. A gunicorn worker that fails to
+# import the app stops the whole server, so a misconfigured deploy never
+# boots. The flask CLI is exempt so commands like export-yolo still work
+# on a machine without them.
+if (not url or not key) and not is_flask_cli():
+    raise SupabaseConfigError("FATAL ERROR: SUPABASE_URL and SUPABASE_KEY not found")
+
+# --- AI Models ---
+# Each model is loaded once per process on first use and then reused.
+
+def load_once(loader):
+    """Caches a no-argument loader like lru_cache(maxsize=1), but also makes
+    sure only one thread runs it. With plain lru_cache, requests that arrive
+    together on a cold worker would each load their own copy of the model."""
+    lock = threading.Lock()
+    cached_loader = lru_cache(maxsize=1)(loader)
+
+    @wraps(loader)
+    def get():
+        with lock:
+            return cached_loader()
+    get.is_loaded = lambda: cached_loader.cache_info().currsize > 0
+    return get
+
+# Loads models in the background on a cold worker (see start_loading)
+model_loader = ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-loader")
+
+def start_loading(get_model):
+    """Starts loading a model in the background if it isn't loaded yet, so
+    a request can download its media while the model loads instead of one
+    after the other."""
+    if not get_model.is_loaded():
+        model_loader.submit(get_model)
+
+# YOLO_BACKEND picks the image model runtime:
+#   ultralytics - Ultralytics YOLO with YOLO_WEIGHTS (.pt, or an .onnx export)
+#   openvino    - an OpenVINO INT8 export (YOLO_OPENVINO_MODEL) run directly
+#                 on the OpenVINO runtime, see OpenVINOYolo
+YOLO_BACKEND = os.environ.get("YOLO_BACKEND", "ultralytics")
+# YOLO_WEIGHTS can point at an exported model (see `flask export-yolo`).
+# yolov8n is plenty for our coarse categories at 320px, which is ~4x less
+# conv work than the default 640px. Half precision only helps on a GPU.
+YOLO_WEIGHTS = os.environ.get("YOLO_WEIGHTS", "yolov8n.pt")
+YOLO_OPENVINO_MODEL = os.environ.get("YOLO_OPENVINO_MODEL", "yolov8n_int8_openvino_model/yolov8n.xml")
+YOLO_IMGSZ = int(os.environ.get("YOLO_IMGSZ", "320"))
+YOLO_HALF = torch.cuda.is_available()
+YOLO_CONF = 0.25 # same minimum box confidence Ultralytics uses
+# OpenVINO saves compiled models here, so worker restarts load the cached
+# blob in milliseconds instead of recompiling for seconds
+OPENVINO_CACHE_DIR = os.environ.get("OPENVINO_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "openvino"))
+
+def letterbox(img, size, out=None):
+    """Fits img onto a grey size x size square like Ultralytics does and
+    returns it as a (3, size, size) float32 array scaled to [0, 1], written
+    into out when given."""
+    if img.mode != 'RGB':
+        img = img.convert('RGB') # convert() copies even when the mode already matches
+    scale = size / max(img.size)
+    resized = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.Resampling.BILINEAR)
+    canvas = Image.new('RGB', (size, size), (114, 114, 114))
+    canvas.paste(resized, ((size - resized.width) // 2, (size - resized.height) // 2))
+    if out is None:
+        out = np.empty((3, size, size), dtype=np.float32)
+    # HWC uint8 -> CHW float32 / 255 in a single vectorized pass, with no
+    # float64 or non-contiguous temporaries on the way
+    np.multiply(np.asarray(canvas).transpose(2, 0, 1), np.float32(1 / 255), out=out)
+    return out
+
+# One reusable input batch per thread, see OpenVINOYolo.predict_labels_async
+yolo_input_buffers = threading.local()
+
+def get_yolo_input_buffer(batch_size):
+    buffer = getattr(yolo_input_buffers, 'batch', None)
+    if buffer is None or len(buffer) < batch_size:
+        buffer = np.empty((batch_size, 3, YOLO_IMGSZ, YOLO_IMGSZ), dtype=np.float32)
+        yolo_input_buffers.batch = buffer
+    return buffer[:batch_size]
+
+class OpenVINOYolo:
+    """Runs an OpenVINO export of yolov8n without Ultralytics.
+
+    The INT8 model runs on OpenVINO's VNNI / AVX-512 CPU kernels, which the
+    PyTorch path doesn't use. Inference goes through an AsyncInferQueue, so
+    requests from several threads are in flight at once instead of taking
+    turns on a single synchronous call.
+    """
+
+    def __init__(self, xml_path):
+        import openvino as ov
+        import yaml
+
+        core = ov.Core()
+        core.set_property({"CACHE_DIR": OPENVINO_CACHE_DIR})
+        model = core.read_model(xml_path)
+        # Free batch dimension so several images can run in one call
+        model.reshape([-1, 3, YOLO_IMGSZ, YOLO_IMGSZ])
+        # THROUGHPUT splits the CPU into parallel streams so queued
+        # requests really run side by side
+        self.compiled = core.compile_model(model, 'CPU', {
+            "PERFORMANCE_HINT": "THROUGHPUT",
+            "INFERENCE_NUM_THREADS": CPU_THREADS,
+        })
+        self.output = self.compiled.output(0)
+
+        # jobs=0 lets OpenVINO pick the optimal number of infer requests
+        self.infer_queue = ov.AsyncInferQueue(self.compiled, jobs=0)
+        self.infer_queue.set_callback(self._on_done)
+        self.infer_lock = threading.Lock()
+
+        # Ultralytics writes the class names next to the exported model
+        with open(os.path.join(os.path.dirname(xml_path), 'metadata.yaml')) as f:
+            self.names = yaml.safe_load(f)['names']
+
+    def predict_labels_async(self, images):
+        """Starts inference and returns a Future of the most confident
+        class name for each image (None where nothing was detected)."""
+        # Preprocess straight into this thread's reusable buffer. That's
+        # safe because start_async copies the input into the infer
+        # request's own tensor before returning.
+        batch = get_yolo_input_buffer(len(images))
+        for i, img in enumerate(images):
+            letterbox(img, YOLO_IMGSZ, out=batch[i])
+        future = Future()
+        with self.infer_lock:
+            # Blocks only while every infer request is busy
+            self.infer_queue.start_async({0: batch}, userdata=future)
+        return future
+
+    def _on_done(self, infer_request, future):
+        # Runs on an OpenVINO thread when a request finishes
+        try:
+            output = infer_request.get_tensor(self.output).data # (batch, 4 box + N class scores, anchors)
+            # Best score of each class over all anchors, then the best class
+            class_scores = output[:, 4:, :].max(axis=2)
+            labels = []
+            for scores in class_scores:
+                top_class = int(scores.argmax())
+                labels.append(self.names[top_class] if scores[top_class] >= YOLO_CONF else None)
+            future.set_result(labels)
+        except Exception as e:
+            future.set_exception(e)
+
+@load_once
+def get_yolo():
+    if YOLO_BACKEND == "openvino":
+        return OpenVINOYolo(YOLO_OPENVINO_MODEL)
+    return YOLO(YOLO_WEIGHTS)
+
+# WHISPER_BACKEND picks the speech model:
+#   auto           - whisper_trt when CUDA is present and it's installed, else faster-whisper
+#   trt            - whisper_trt (TensorRT), fails if it's not installed
+#   faster-whisper - faster-whisper (CTranslate2) on GPU or CPU
+WHISPER_BACKEND = os.environ.get("WHISPER_BACKEND", "auto")
+
+class FasterWhisperTranscriber:
+    """Gives faster-whisper the same transcribe(audio)['text'] shape as whisper / whisper_trt."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def transcribe(self, audio):
+        # Greedy decoding + VAD so silent stretches are skipped entirely.
+        # We only keep the text, so don't spend decoder steps on timestamp
+        # tokens either.
+        segments, _ = self.model.transcribe(audio, beam_size=1, vad_filter=True, without_timestamps=True)
+        return {"text": "".join(segment.text for segment in segments)}
+
+@load_once
+def get_whisper():
+    has_cuda = ctranslate2.get_cuda_device_count() > 0
+
+    if WHISPER_BACKEND == "trt" or (WHISPER_BACKEND == "auto" and has_cuda):
+        try:
+            # whisper_trt caches the built TensorRT engine under
+            # ~/.cache/whisper_trt/, so only the first start pays the build.
+            from whisper_trt import load_trt_model
+            return load_trt_model(os.environ.get("WHISPER_TRT_MODEL", "tiny.en"))
+        except ImportError:
+            if WHISPER_BACKEND == "trt":
+                raise
+            print("whisper_trt not installed, falling back to faster-whisper")
+
+    # faster-whisper (CTranslate2) with INT8 weights is several times
+    # quicker than the PyTorch whisper on CPU.
+    if has_cuda:
+        model = WhisperModel("tiny", device="cuda", compute_type="float16")
+    else:
+        model = WhisperModel("tiny", device="cpu", compute_type="int8", cpu_threads=CPU_THREADS)
+    return FasterWhisperTranscriber(model)
+
+# --- YOLO Micro-Batching ---
+# Concurrent image requests are grouped into one predict() call, which is
+# much cheaper per image than predicting them one by one. YOLO_BATCH=1 (the
+# default, for dev) skips the queue and predicts on the calling thread.
+#
+# Images only reach YOLO from the AI_WORKERS background threads (see
+# Background AI Processing below), so a batch can never hold more than
+# AI_WORKERS images; a bigger YOLO_BATCH would just wait out YOLO_WAIT_MS
+# for images that can't arrive.
+AI_WORKERS = int(os.environ.get("AI_WORKERS", "2"))
+YOLO_BATCH = min(int(os.environ.get("YOLO_BATCH", "1")), AI_WORKERS)
+YOLO_WAIT_MS = int(os.environ.get("YOLO_WAIT_MS", "50"))
+YOLO_TIMEOUT = 120 # seconds a request will wait for its batch
+
+class MicroBatcher:
+    """Collects items submitted from many threads and runs them through run_batch together.
 
-# We initialize Supabase with the SERVICE_ROLE key for admin powers
-supabase: Client = create_client(url, key)
+    run_batch takes a list of items and returns a Future of their results
+    in the same order. Because it returns a Future rather than blocking, an
+    async backend can have several batches in flight at once.
+    """
+
+    def __init__(self, run_batch, max_batch, max_wait_ms):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, item, timeout=None):
+        """Blocks until the batch containing item has run and returns its result."""
+        if self.max_batch <= 1:
+            return self.run_batch([item]).result(timeout=timeout)[0]
+
+        self._start()
+        future = Future()
+        self._queue.put((item, future))
+        return future.result(timeout=timeout)
+
+    def _start(self):
+        # The consumer thread is started on first use so it's created in
+        # the serving process, not in a parent that later forks.
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                batch_future = self.run_batch([item for item, _ in batch])
+            except Exception as e:
+                batch_future = Future()
+                batch_future.set_exception(e)
+            batch_future.add_done_callback(lambda done, batch=batch: self._scatter(batch, done))
+
+    def _scatter(self, batch, batch_future):
+        error = batch_future.exception()
+        if error is not None:
+            for _, future in batch:
+                future.set_exception(error)
+            return
+
+        for (_, future), result in zip(batch, batch_future.result()):
+            future.set_result(result)
+
+def yolo_label(result):
+    """Top class name from an Ultralytics result, or None."""
+    # Classification models fill in probs, detection models like yolov8n
+    # fill in boxes (probs is None for them)
+    if result.probs is not None:
+        return result.names[result.probs.top1]
+    if result.boxes is None or len(result.boxes) == 0:
+        return None
+    # A single argmax on the tensor; only two scalars leave the device
+    top_idx = int(result.boxes.conf.argmax().item())
+    return result.names[int(result.boxes.cls[top_idx].item())]
+
+# The Ultralytics predictor isn't thread-safe and every caller shares the
+# one cached model, so only one thread may predict at a time. (With
+# YOLO_BATCH > 1 only the batcher thread predicts anyway.)
+yolo_predict_lock = threading.Lock()
+
+def predict_yolo_batch(images):
+    """Returns a Future of the top class name (or None) for each image."""
+    if YOLO_BACKEND == "openvino":
+        # The whole batch is written into one buffer along the dynamic batch
+        # dimension, goes through one infer request, and returns without
+        # waiting for it
+        return get_yolo().predict_labels_async(images)
+
+    future = Future()
+    try:
+        # YOLO accepts a list of sources and returns one result per source
+        with yolo_predict_lock:
+            results = get_yolo().predict(images, imgsz=YOLO_IMGSZ, half=YOLO_HALF)
+        future.set_result([yolo_label(result) for result in results])
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+yolo_batcher = MicroBatcher(predict_yolo_batch, YOLO_BATCH, YOLO_WAIT_MS)
+
+def warm_up_models():
+    """Loads both models and runs one dummy inference through each."""
+    predict_yolo_batch([Image.new('RGB', (YOLO_IMGSZ, YOLO_IMGSZ))]).result()
+    get_whisper().transcribe(np.zeros(16000, dtype=np.float32)) # 1 second of silence
 
 
 # --- NEW: Authentication Helper ---
+# Supabase access tokens are HS256 JWTs signed with the project's JWT
+# secret, so with SUPABASE_JWT_SECRET set we can check them here instead of
+# a round-trip to supabase.auth.get_user on every request.
+SUPABASE_JWT_SECRET = os.environ.get("SUPABASE_JWT_SECRET")
+
+# Roles rarely change, so remember them for 5 minutes instead of reading
+# 'profiles' on every request. cachetools caches aren't thread-safe.
+role_cache = TTLCache(maxsize=4096, ttl=300)
+role_cache_lock = threading.Lock()
+
+def verify_token_locally(jwt_token):
+    """Returns the user for a token we can verify without Supabase, else None."""
+    if not SUPABASE_JWT_SECRET:
+        return None
+    try:
+        claims = jwt.decode(jwt_token, SUPABASE_JWT_SECRET, algorithms=['HS256'], audience='authenticated')
+    except jwt.InvalidTokenError:
+        return None
+    return SimpleNamespace(id=claims['sub'], email=claims.get('email'))
+
+def get_user_role(user):
+    """Gets the user's role from our 'profiles' table (Self-Healing)."""
+    profile_response = get_supabase().table('profiles').select('role').eq('id', user.id).execute()
+    
+    # --- THIS IS THE FIX ---
+    # Check if the user has a profile
+    if not profile_response.data:
+        # User exists in Auth, but not in profiles. Let's create it.
+        # This fixes the "0 rows" race condition.
+        
+        # Get the user's email from the auth user object
+        user_email = user.email
+        
+        # By default, all new auto-created profiles are 'citizen'
+        # (Admins must be set manually in the database)
+        new_profile_data = {
+            'id': user.id,
+            'email': user_email,
+            'role': 'citizen'
+        }
+        
+        # We never read the new row back, so don't ask for it
+        get_supabase().table('profiles').insert(new_profile_data, returning="minimal").execute()
+        
+        # Now that the profile is created, set the role
+        return 'citizen'
+
+    # Profile was found, get the role
+    return profile_response.data[0].get('role', 'citizen')
+    # --- END OF FIX ---
+
+# Bodies for the 401 responses, serialized once at startup. Each request
+# still gets its own Response object because CORS adds headers to it.
+MISSING_AUTH_BODY = orjson.dumps({"error": "Missing Authorization header"})
+INVALID_TOKEN_BODY = orjson.dumps({"error": "Invalid token"})
+
+def unauthorized(body):
+    return app.response_class(body, status=401, mimetype="application/json")
+
 # --- NEW: Authentication Helper (Self-Healing) ---
 def get_user_from_token():
-    """Gets the user's info from the Authorization token."""
+    """Gets the user's info from the Authorization token.
+
+    Returns (user, role, None), or (None, None, a 401 response to return).
+    """
     try:
         auth_header = request.headers.get("Authorization")
         if not auth_header:
-            return None, {"error": "Missing Authorization header"}, 401
+            return None, None, unauthorized(MISSING_AUTH_BODY)
 
-        jwt_token = auth_header.split(" ")[1]
+        # The auth scheme is case-insensitive (RFC 7235), so "bearer" is fine too
+        scheme, _, jwt_token = auth_header.partition(" ")
+        jwt_token = jwt_token.strip()
+        if scheme.lower() != "bearer" or not jwt_token:
+            return None, None, unauthorized(INVALID_TOKEN_BODY)
         
-        user_response = supabase.auth.get_user(jwt_token)
-        user = user_response.user
+        user = verify_token_locally(jwt_token)
+        if user is None:
+            # No secret configured, or a token we can't check ourselves
+            # (e.g. expired), so let Supabase decide
+            user_response = get_supabase().auth.get_user(jwt_token)
+            user = user_response.user
         
         if not user:
-            return None, {"error": "Invalid token"}, 401
-            
-        # Get the user's role from our 'profiles' table
-        profile_response = supabase.table('profiles').select('role').eq('id', user.id).execute()
-        
-        # --- THIS IS THE FIX ---
-        # Check if the user has a profile
-        if not profile_response.data:
-            # User exists in Auth, but not in profiles. Let's create it.
-            # This fixes the "0 rows" race condition.
-            
-            # Get the user's email from the auth user object
-            user_email = user.email
-            
-            # By default, all new auto-created profiles are 'citizen'
-            # (Admins must be set manually in the database)
-            new_profile_data = {
-                'id': user.id,
-                'email': user_email,
-                'role': 'citizen'
-            }
-            
-            insert_response = supabase.table('profiles').insert(new_profile_data).execute()
+            return None, None, unauthorized(INVALID_TOKEN_BODY)
             
-            # Now that the profile is created, set the role
-            role = 'citizen'
-            
-        else:
-            # Profile was found, get the role
-            role = profile_response.data[0].get('role', 'citizen')
-        # --- END OF FIX ---
+        with role_cache_lock:
+            role = role_cache.get(user.id)
+        if role is None:
+            role = get_user_role(user)
+            with role_cache_lock:
+                role_cache[user.id] = role
 
         return user, role, None # user, role, no error
     
+    except SupabaseConfigError:
+        raise # a broken deploy, not a bad token
     except Exception as e:
         print(f"Auth error: {e}")
-        return None, {"error": "Invalid token"}, 401
+        return None, None, unauthorized(INVALID_TOKEN_BODY)
     
 # --- AI Helper Functions ---
-# (These are the same as before, no changes needed)
-def get_category_from_image(media_url):
+# One pooled session for all media downloads, so repeat requests to the
+# same storage host reuse the TCP/TLS connection instead of handshaking.
+http_session = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+# Media is streamed instead of buffered whole with response.content. Images
+# and audio are already compressed, so ask the server not to gzip them.
+http_session.headers["Accept-Encoding"] = "identity"
+MEDIA_TIMEOUT = (3, 30) # (connect, read) seconds
+AUDIO_SPOOL_SIZE = 16 * 1024 * 1024 # audio bigger than this is spooled to disk
+
+# --- Media Result Cache ---
+# The same media_url submitted again (a retry, the same photo reported
+# twice) reuses the earlier AI result instead of re-running the model.
+# Results live in a small SQLite file so all workers on the box share them.
+MEDIA_CACHE_PATH = os.environ.get("MEDIA_CACHE_PATH", os.path.join(tempfile.gettempdir(), "myvoice_media_cache.db"))
+MEDIA_CACHE_TTL = 30 * 24 * 60 * 60 # 30 days, in seconds
+media_cache_local = threading.local() # one SQLite connection per thread
+
+def get_media_cache():
+    conn = getattr(media_cache_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(MEDIA_CACHE_PATH, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL") # readers don't block the writer
+        conn.execute("CREATE TABLE IF NOT EXISTS media_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)")
+        media_cache_local.conn = conn
+    return conn
+
+def media_cache_key(kind, media_url):
+    # Hashing the URL (not the bytes) is essentially free
+    return f"{kind}:{hashlib.sha256(media_url.encode()).hexdigest()}"
+
+def media_cache_get(cache_key):
+    """Returns the cached value, or None on a miss or an expired entry."""
     try:
-        yolo_model = YOLO('yolov8n.pt') 
-        response = requests.get(media_url)
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_file:
-            temp_file.write(response.content)
-            temp_file_path = temp_file.name
-        results = yolo_model.predict(temp_file_path)
-        os.remove(temp_file_path)
-        
-        if results[0].names:
-            top_result_index = results[0].probs.top1
-            top_category = results[0].names[top_result_index]
-            if 'pothole' in top_category: return 'Pothole'
-            if 'person' in top_category: return 'Social Issue'
-            return top_category
-        return "Uncategorized Image"
+        row = get_media_cache().execute(
+            "SELECT value FROM media_cache WHERE key = ? AND created_at > ?",
+            (cache_key, time.time() - MEDIA_CACHE_TTL),
+        ).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        print(f"Media cache read error: {e}")
+        return None
+
+def media_cache_set(cache_key, value):
+    try:
+        conn = get_media_cache()
+        conn.execute("INSERT OR REPLACE INTO media_cache VALUES (?, ?, ?)", (cache_key, value, time.time()))
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Media cache write error: {e}")
+
+def category_from_yolo_label(top_category):
+    if top_category:
+        if 'pothole' in top_category: return 'Pothole'
+        if 'person' in top_category: return 'Social Issue'
+        return top_category
+    return "Uncategorized Image"
+
+def get_category_from_image(media_url, batched=True):
+    if not isinstance(media_url, str) or not media_url:
+        return "Uncategorized"
+
+    cache_key = media_cache_key('image', media_url)
+    category = media_cache_get(cache_key)
+    if category is not None:
+        return category
+
+    start_loading(get_yolo)
+    try:
+        with http_session.get(media_url, stream=True, timeout=MEDIA_TIMEOUT) as response:
+            response.raw.decode_content = True
+            # PIL reads a non-seekable stream into memory anyway, so holding
+            # the bytes ourselves costs nothing extra and lets us hash them
+            image_bytes = response.raw.read()
+
+        # The same photo re-uploaded under a new URL: hashing a few MB
+        # takes microseconds, YOLO takes hundreds of milliseconds
+        content_cache_key = f"image-bytes:{hashlib.blake2b(image_bytes, digest_size=16).hexdigest()}"
+        category = media_cache_get(content_cache_key)
+        if category is not None:
+            media_cache_set(cache_key, category)
+            return category
+
+        img = Image.open(io.BytesIO(image_bytes))
+        # For JPEGs, let libjpeg decode straight at 1/2, 1/4 or 1/8 scale
+        # instead of decoding all 12 MP of a phone photo. No-op otherwise.
+        img.draft('RGB', (YOLO_IMGSZ, YOLO_IMGSZ))
+        # Shrink to the inference size up front (this also loads the
+        # pixels) so YOLO never letterboxes a full-res phone photo.
+        img.thumbnail((YOLO_IMGSZ, YOLO_IMGSZ), Image.Resampling.BILINEAR)
+        if batched:
+            top_category = yolo_batcher.submit(img, timeout=YOLO_TIMEOUT)
+        else:
+            top_category = predict_yolo_batch([img]).result(timeout=YOLO_TIMEOUT)[0]
+        category = category_from_yolo_label(top_category)
     except Exception as e:
         print(f"Error processing image: {e}")
         return "Uncategorized"
 
+    media_cache_set(cache_key, category)
+    media_cache_set(content_cache_key, category)
+    return category
+
 def get_text_from_audio(media_url):
+    if not isinstance(media_url, str) or not media_url:
+        return ""
+
+    cache_key = media_cache_key('audio', media_url)
+    text = media_cache_get(cache_key)
+    if text is not None:
+        return text
+
+    start_loading(get_whisper)
     try:
-        whisper_model = whisper.load_model('tiny')
-        response = requests.get(media_url)
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.tmp') as temp_file:
-            temp_file.write(response.content)
-            temp_file_path = temp_file.name
-        result = whisper_model.transcribe(temp_file_path)
-        os.remove(temp_file_path)
-        return result.get('text', '')
+        # Voice notes stay in memory; only long recordings spill to disk.
+        # PyAV needs a seekable file (MP4/M4A can keep their index at the
+        # end), so the download can't be decoded straight off the socket.
+        with tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_SIZE) as audio_file:
+            with http_session.get(media_url, stream=True, timeout=MEDIA_TIMEOUT) as response:
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, audio_file, length=1 << 20) # 1 MiB chunks
+            audio_file.seek(0)
+            # Decode to 16 kHz mono float32 with PyAV instead of handing
+            # ffmpeg a temp file to read back off the disk.
+            audio = decode_audio(audio_file)
+        text = get_whisper().transcribe(audio)['text']
     except Exception as e:
         print(f"Error processing audio: {e}")
         return ""
 
+    media_cache_set(cache_key, text)
+    return text
+
+# Category -> keywords. When a text matches several categories, the one
+# listed first wins.
+TEXT_CATEGORY_KEYWORDS = [
+    ('Pothole', ['pothole', 'road broken']),
+    ('Streetlight Issue', ['streetlight', 'light', 'lamp']),
+    ('Waste Management', ['trash', 'garbage']),
+]
+# All keywords in one pattern, with one group per category in priority
+# order, so the text is scanned once and match.lastindex says which
+# category (and priority) matched. re.IGNORECASE saves lowercasing a copy
+# of every (possibly long) transcript.
+TEXT_CATEGORY_RE = re.compile(
+    '|'.join(f"({'|'.join(map(re.escape, keywords))})" for _, keywords in TEXT_CATEGORY_KEYWORDS),
+    re.IGNORECASE,
+)
+
 def get_category_from_text(text_description):
-    text_lower = text_description.lower()
-    if 'pothole' in text_lower or 'road broken' in text_lower: return 'Pothole'
-    if 'streetlight' in text_lower or 'light' in text_lower: return 'Streetlight Issue'
-    if 'trash' in text_lower or 'garbage' in text_lower: return 'Waste Management'
-    return 'General Inquiry'
+    best_group = None
+    for match in TEXT_CATEGORY_RE.finditer(text_description):
+        if best_group is None or match.lastindex < best_group:
+            best_group = match.lastindex
+            if best_group == 1: break # nothing can beat the first category
+    if best_group is None:
+        return 'General Inquiry'
+    return TEXT_CATEGORY_KEYWORDS[best_group - 1][0]
+
+# --- Background AI Processing ---
+# /api/issue saves the issue straight away and the slow YOLO / Whisper work
+# runs here afterwards. Clients poll GET /api/issue/<id> for the result.
+#
+# With REDIS_URL set, the work goes onto an RQ queue and runs in a separate
+# worker process, so the web workers never hold the models at all:
+#   rq worker --worker-class rq.worker.SimpleWorker --url $REDIS_URL ai
+# (SimpleWorker runs jobs in-process, so the models stay loaded between
+# jobs instead of being reloaded by a fresh fork every time.)
+# Without it, a thread pool in each web worker does the work.
+REDIS_URL = os.environ.get("REDIS_URL")
+AI_JOB_TIMEOUT = 600 # seconds, long recordings take a while to transcribe
+ai_executor = ThreadPoolExecutor(max_workers=AI_WORKERS, thread_name_prefix="ai")
+
+@lru_cache(maxsize=1)
+def get_ai_queue():
+    return Queue("ai", connection=Redis.from_url(REDIS_URL))
+
+# Results are written behind: AI threads queue their finished update here
+# and go straight on to the next issue instead of waiting on Supabase.
+ISSUE_WRITERS = int(os.environ.get("ISSUE_WRITERS", "2"))
+issue_writer = ThreadPoolExecutor(max_workers=ISSUE_WRITERS, thread_name_prefix="issue-writer")
+
+def save_issue_update(issue_id, update_data):
+    try:
+        get_supabase().table('issues').update(update_data, returning="minimal").eq('id', issue_id).execute()
+    except Exception as e:
+        print(f"Error saving issue {issue_id}: {e}")
+
+def process_issue_media(issue_id, media_url, media_type, description_text, write_behind=True, batched=True):
+    """Runs the AI helpers for an issue and saves the result on its row.
+
+    write_behind queues the save on issue_writer. RQ jobs pass False and
+    save inline, since nothing would wait for the writer once the job ends.
+    RQ jobs also pass batched=False: SimpleWorker runs one job at a time, so
+    yolo_batcher would only ever wait out YOLO_WAIT_MS for a batch of one.
+    """
+    try:
+        update_data = {}
+        if media_type == 'image':
+            update_data['category'] = get_category_from_image(media_url, batched=batched)
+        else:
+            ai_transcription = get_text_from_audio(media_url)
+            description_text = f"User Text: {description_text}\n\nAudio Transcription: {ai_transcription}"
+            update_data['description_text'] = description_text
+            update_data['category'] = get_category_from_text(description_text)
+
+        if write_behind:
+            issue_writer.submit(save_issue_update, issue_id, update_data)
+        else:
+            save_issue_update(issue_id, update_data)
+    except Exception as e:
+        print(f"Error processing issue {issue_id}: {e}")
+        # Clients poll until the category stops being "Processing", so
+        # always give the row a final one
+        save_issue_update(issue_id, {'category': 'Uncategorized'})
+
+def queue_issue_media(issue_id, media_url, media_type, description_text):
+    """Hands an issue's AI work to the RQ worker, or the local thread pool."""
+    if REDIS_URL:
+        try:
+            get_ai_queue().enqueue(
+                process_issue_media, issue_id, media_url, media_type, description_text,
+                write_behind=False, batched=False, job_timeout=AI_JOB_TIMEOUT,
+            )
+            return
+        except Exception as e:
+            # The row is already saved, so don't fail the request (a retry
+            # would create a duplicate issue) or leave it "Processing"
+            # forever. Do the work here instead.
+            print(f"Error queueing issue {issue_id}, processing locally: {e}")
+
+    ai_executor.submit(process_issue_media, issue_id, media_url, media_type, description_text)
+
+# Set WARMUP_MODELS=1 to pay the model load + first-inference cost at
+# startup instead of on the first /api/issue request. With REDIS_URL set
+# the web processes never run the models, so they skip this (the RQ worker
+# loads them on its first job and keeps them).
+if os.environ.get("WARMUP_MODELS") == "1" and not REDIS_URL:
+    warm_up_models()
 
 # --- API Routes (Now Secured) ---
 
+@app.errorhandler(SupabaseConfigError)
+def supabase_config_error(e):
+    print(e)
+    return jsonify({"error": "Server is missing its Supabase configuration"}), 500
+
 @app.route('/')
 def home():
     return "Python API for Smart City App is running!"
 
 @app.route('/api/issue', methods=['POST'])
 def create_issue():
-    """Creates a new issue (SECURED)"""
+    """Creates a new issue (SECURED)
+
+    Issues with media are saved with category "Processing" and answered with
+    202; the AI result is filled in by process_issue_media in the background.
+    """
     user, role, error = get_user_from_token()
     if error:
-        return jsonify(error), 401 # Return 401 Unauthorized
+        return error # 401 Unauthorized
 
     try:
         data = request.get_json()
@@ -146,15 +783,22 @@ def create_issue():
         media_type = data.get('media_type')
         description_text = data.get('description_text', '')
         
+        needs_ai = media_type in ('image', 'audio', 'video')
+        if needs_ai and (not isinstance(media_url, str) or not media_url):
+            return jsonify({"error": f"media_url is required for media_type '{media_type}'"}), 400
+
         ai_category = "Uncategorized"
-        if media_type == 'image':
-            ai_category = get_category_from_image(media_url)
-        elif media_type == 'audio' or media_type == 'video':
-            ai_transcription = get_text_from_audio(media_url)
-            description_text = f"User Text: {description_text}\n\nAudio Transcription: {ai_transcription}"
-            ai_category = get_category_from_text(description_text)
-        elif description_text:
+        if description_text:
             ai_category = get_category_from_text(description_text)
+
+        # The keyword match takes microseconds and YOLO hundreds of ms, so
+        # when the user's own text already names the problem, trust it and
+        # skip the image model.
+        if media_type == 'image' and ai_category not in ("Uncategorized", "General Inquiry"):
+            needs_ai = False
+
+        if needs_ai:
+            ai_category = "Processing"
         
         insert_data = {
             "description_text": description_text,
@@ -167,27 +811,52 @@ def create_issue():
             "submitted_by": user.id  # <-- FINAL FIX: We add the user's ID!
         }
         
-        response = supabase.table('issues').insert(insert_data).execute()
+        response = get_supabase().table('issues').insert(insert_data).execute()
         new_issue = response.data[0]
+
+        if needs_ai:
+            queue_issue_media(new_issue['id'], media_url, media_type, description_text)
+            return jsonify(new_issue), 202 # Accepted, AI still running
         return jsonify(new_issue), 201
 
     except Exception as e:
         print(f"Error creating issue: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/issue/<int:issue_id>', methods=['GET'])
+def get_issue(issue_id):
+    """Gets one issue (SECURED - Admin or the user who submitted it)"""
+    user, role, error = get_user_from_token()
+    if error:
+        return error
+
+    try:
+        response = get_supabase().table('issues').select('*').eq('id', issue_id).execute()
+        if not response.data:
+            return jsonify({"error": "Issue not found"}), 404
+
+        issue = response.data[0]
+        if role != 'admin' and issue.get('submitted_by') != user.id:
+            return jsonify({"error": "You can only view your own issues"}), 403
+
+        return jsonify(issue), 200
+    except Exception as e:
+        print(f"Error getting issue: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/issues', methods=['GET'])
 def get_issues():
     """Gets all issues (SECURED - Admin Only)"""
     user, role, error = get_user_from_token()
     if error:
-        return jsonify(error), 401
+        return error
         
     # <-- FINAL FIX: Only allow "admin" to see all issues
     if role != 'admin':
         return jsonify({"error": "You must be an admin to access this"}), 403 # 403 Forbidden
 
     try:
-        response = supabase.table('issues').select('*').order('created_at', desc=True).execute()
+        response = get_supabase().table('issues').select('*').order('created_at', desc=True).execute()
         issues = response.data
         return jsonify(issues), 200
     except Exception as e:
@@ -199,7 +868,7 @@ def update_issue(issue_id):
     """Updates an issue (SECURED - Admin Only)"""
     user, role, error = get_user_from_token()
     if error:
-        return jsonify(error), 401
+        return error
 
     if role != 'admin':
         return jsonify({"error": "You must be an admin to access this"}), 403
@@ -214,7 +883,7 @@ def update_issue(issue_id):
         if not update_data:
             return jsonify({"error": "No valid fields to update"}), 400
 
-        response = supabase.table('issues').update(update_data).eq('id', issue_id).execute()
+        response = get_supabase().table('issues').update(update_data).eq('id', issue_id).execute()
         updated_issue = response.data[0]
         return jsonify(updated_issue), 200
     except Exception as e:
@@ -226,7 +895,7 @@ def update_operator_location():
     """Updates an operator's live GPS location (SECURED)"""
     user, role, error = get_user_from_token()
     if error:
-        return jsonify(error), 401
+        return error
 
     # <-- FINAL FIX: Only operators can update their location
     if role != 'operator':
@@ -237,7 +906,7 @@ def update_operator_location():
         new_location = {"lat": data.get('lat'), "lng": data.get('lng')}
 
         # Use the user.id from the token, not from the JSON body
-        response = supabase.table('operators') \
+        response = get_supabase().table('operators') \
                          .update({"current_location": new_location}) \
                          .eq('user_id', user.id) \
                          .execute()
@@ -250,7 +919,63 @@ def update_operator_location():
         print(f"Error updating location: {e}")
         return jsonify({"error": str(e)}), 500
 
+# --- CLI Commands ---
+
+@app.cli.command("export-yolo")
+@click.option('--format', 'export_format', type=click.Choice(['onnx', 'openvino']), default='onnx', help="onnx for YOLO_WEIGHTS, openvino for YOLO_BACKEND=openvino.")
+@click.option('--int8', is_flag=True, help="Also quantize the model to INT8.")
+@click.option('--calib-dir', type=click.Path(exists=True, file_okay=False), help="Folder of sample photos to calibrate an ONNX --int8 export with.")
+def export_yolo(export_format, int8, calib_dir):
+    """Exports yolov8n.pt to ONNX or OpenVINO. Run with: flask --app app export-yolo [--format openvino] [--int8]"""
+    if export_format == 'openvino':
+        # Ultralytics quantizes OpenVINO exports itself (NNCF), calibrating
+        # on the small coco128 sample set.
+        path = YOLO('yolov8n.pt').export(format='openvino', imgsz=YOLO_IMGSZ, dynamic=True, int8=int8, data='coco128.yaml')
+        print(f"Exported {path}, set YOLO_BACKEND=openvino and point YOLO_OPENVINO_MODEL at the .xml inside it")
+        return
+
+    # dynamic=True keeps the batch dimension free for the micro-batcher
+    path = YOLO('yolov8n.pt').export(format='onnx', imgsz=YOLO_IMGSZ, dynamic=True)
+
+    if int8:
+        # Static INT8 (QDQ) runs on ONNX Runtime's VNNI kernels on modern x86
+        # CPUs, roughly 2-3x quicker than FP32 for yolov8n. The activation
+        # ranges are calibrated on real photos, so point --calib-dir at a
+        # few dozen past uploads.
+        if not calib_dir:
+            raise click.UsageError("--int8 needs --calib-dir")
+        import onnxruntime
+        from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+        input_name = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+        photo_paths = [os.path.join(calib_dir, name) for name in sorted(os.listdir(calib_dir))]
+
+        class PhotoReader(CalibrationDataReader):
+            def __init__(self):
+                self.paths = iter(photo_paths)
+
+            def get_next(self):
+                for photo_path in self.paths:
+                    try:
+                        return {input_name: letterbox(Image.open(photo_path), YOLO_IMGSZ)[None]}
+                    except OSError:
+                        continue # not an image
+                return None
+
+        int8_path = path.replace('.onnx', '_int8.onnx')
+        quantize_static(
+            path, int8_path, PhotoReader(),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+        path = int8_path
+
+    print(f"Exported {path}, set YOLO_WEIGHTS={path} to use it")
+
 # --- This runs the app locally ---
+# (Production runs under gunicorn with threaded workers, see render.yaml)
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+    app.run(debug=True, port=5000, threaded=True)
 